@@ -1,22 +1,49 @@
 #!/usr/bin/env python
+import argparse
 import os
 
 import panda3d.core as p3d
 
 from simplepbr import _ibl_funcs_cpu as iblfuncs
 
+
+DEFAULT_OUTPUT = os.path.join(
+    os.path.dirname(__file__),
+    '..',
+    'simplepbr',
+    'textures',
+    'brdf_lut.txo'
+)
+
 def main():
-    brdflut = iblfuncs.gen_brdf_lut(512, num_samples=1024)
-    outfile = p3d.Filename.from_os_specific(
-        os.path.join(
-            os.path.dirname(__file__),
-            '..',
-            'simplepbr',
-            'textures',
-            'brdf_lut.txo'
-        )
+    parser = argparse.ArgumentParser(
+        description='Generate the BRDF LUT texture that ships with simplepbr',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        '--size',
+        type=int,
+        help='the size to use for both dimensions of the LUT',
+        default=512
     )
-    brdflut.write(outfile)
+    parser.add_argument(
+        '--samples',
+        type=int,
+        help='the number of samples to use for each pixel of the LUT',
+        default=1024
+    )
+    parser.add_argument(
+        '--output',
+        type=str,
+        help='destination file',
+        default=DEFAULT_OUTPUT
+    )
+
+    args = parser.parse_args()
+
+    brdflut = iblfuncs.gen_brdf_lut(args.size, num_samples=args.samples)
+    brdflut.write(p3d.Filename.from_os_specific(args.output))
 
 if __name__ == '__main__':
     main()
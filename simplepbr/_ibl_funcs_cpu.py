@@ -1,81 +1,69 @@
 from __future__ import annotations
 # pylint: disable=invalid-name
 
+import concurrent.futures
 import functools
-import math
-import struct
-import typing
+import os
 from typing_extensions import (
     TypeAlias,
     Final,
 )
 
+import numpy as np
+import numpy.typing as npt
 import panda3d.core as p3d
 
-Vec2TupleType: TypeAlias = 'tuple[float, float]'
-Vec3TupleType: TypeAlias = 'tuple[float, float, float]'
-SHTupleType: TypeAlias = '''tuple[
-    float,
-    float,
-    float,
-    float,
-    float,
-    float,
-    float,
-    float,
-    float,
-]'''
-
-
-def calc_vector(dim: int, face_idx: int, xloc: float, yloc: float) -> Vec3TupleType:
-    maxidx = dim - 1
-    # Remap [0, dimension] to [-1, 1]
-    xcoord = xloc / maxidx * 2 - 1
-    ycoord = (maxidx - yloc) / maxidx * 2 - 1
-
-    # This should always be the largest component, so add some room for
-    # xcoord or ycoord to be 1.0
-    unitlength = 1.00001
-
-    if face_idx == 0:
-        vec = (unitlength, ycoord, -xcoord)
-    elif face_idx == 1:
-        vec = (-unitlength, ycoord, xcoord)
-    elif face_idx == 2:
-        vec = (xcoord, unitlength, -ycoord)
-    elif face_idx == 3:
-        vec = (xcoord, -unitlength, ycoord)
-    elif face_idx == 4:
-        vec = (xcoord, ycoord, unitlength)
-    elif face_idx == 5:
-        vec = (-xcoord, ycoord, -unitlength)
-
-    return vec
-
-
-def calc_solid_angle(invdim: float, x: float, y: float) -> float:
-    s = ((x + 0.5) * 2 * invdim) - 1
-    t = ((y + 0.5) * 2 * invdim) - 1
-    x0 = s - invdim
-    y0 = t - invdim
-    x1 = s + invdim
-    y1 = t + invdim
-
-    x02 = x0 * x0
-    y02 = y0 * y0
-    x12 = x1 * x1
-    y12 = y1 * y1
-
-    return math.atan2(x0*y0, math.sqrt(x02 + y02  + 1)) - \
-        math.atan2(x0*y1, math.sqrt(x02 + y12 + 1)) - \
-        math.atan2(x1*y0, math.sqrt(x12 + y02 + 1)) + \
-        math.atan2(x1*y1, math.sqrt(x12 + y12 + 1))
-
-
-def get_sh_basis_from_vector(vec: Vec3TupleType) -> SHTupleType:
-    vecx, vecy, vecz = vec
-    return (
-        0.282095,
+FloatArrayType: TypeAlias = npt.NDArray[np.floating]
+
+# Bump whenever the results of these functions change to invalidate cached results
+VERSION: Final = 3
+
+
+# Per face axes that xcoord, ycoord, and the major axis map to, such that a texel's
+# direction is (xcoord, ycoord, 1) @ CUBE_FACE_AXES[face]
+CUBE_FACE_AXES: Final = np.array([
+    [(0, 0, -1), (0, 1, 0), (1, 0, 0)],
+    [(0, 0, 1), (0, 1, 0), (-1, 0, 0)],
+    [(1, 0, 0), (0, 0, -1), (0, 1, 0)],
+    [(1, 0, 0), (0, 0, 1), (0, -1, 0)],
+    [(1, 0, 0), (0, 1, 0), (0, 0, 1)],
+    [(-1, 0, 0), (0, 1, 0), (0, 0, -1)],
+], dtype=np.float32)
+
+# Component index and sign of each entry in CUBE_FACE_AXES
+CUBE_FACE_COMPONENTS: Final = np.argmax(np.abs(CUBE_FACE_AXES), axis=-1)
+CUBE_FACE_SIGNS: Final = np.sum(CUBE_FACE_AXES, axis=-1)
+
+
+def calc_vectors(dim: int) -> FloatArrayType:
+    # Direction for every texel of every face, indexed by (face, y, x)
+    # Remap texel centers to (-1, 1), matching calc_solid_angles()
+    coords = (np.arange(dim, dtype=np.float32) + 0.5) * (2 / dim) - 1
+    xcoord, ycoord = np.broadcast_arrays(coords, -coords[:, None])
+
+    local = np.stack([xcoord, ycoord, np.ones_like(xcoord)], axis=-1)
+    return np.einsum('yxk,fkj->fyxj', local, CUBE_FACE_AXES)
+
+
+def calc_solid_angles(dim: int) -> FloatArrayType:
+    # Solid angle of every texel of a face, indexed by (y, x)
+    # Each texel is the signed sum of the sphere quadrant areas at its four corners, and
+    # neighboring texels share corners, so evaluate the areas once on the corner grid
+    corners = np.arange(dim + 1) * 2 / dim - 1
+    corners2 = corners * corners
+    areas = np.arctan2(
+        corners[:, None] * corners[None, :],
+        np.sqrt(corners2[:, None] + corners2[None, :] + 1)
+    )
+
+    return areas[:-1, :-1] - areas[:-1, 1:] - areas[1:, :-1] + areas[1:, 1:]
+
+
+def get_sh_basis_from_vector(vec: FloatArrayType) -> FloatArrayType:
+    # Accepts any array of vectors with components along the last axis
+    vecx, vecy, vecz = np.moveaxis(np.asarray(vec), -1, 0)
+    return np.stack([
+        np.full_like(vecx, 0.282095),
         0.488603 * vecx,
         0.488603 * vecz,
         0.488603 * vecy,
@@ -84,211 +72,334 @@ def get_sh_basis_from_vector(vec: Vec3TupleType) -> SHTupleType:
         1.092548 * vecy * vecx,
         (0.946176 * vecz * vecz - 0.315392),
         0.546274 * (vecx * vecx - vecy * vecy),
-    )
+    ], axis=-1)
 
-def get_sh_coeffs_from_cube_map(texcubemap: p3d.Texture) -> list[p3d.LVector3]:
-    if texcubemap.z_size != 6:
-        raise RuntimeError('supplied texture was not a cube map')
-    if texcubemap.x_size != texcubemap.y_size:
-        raise RuntimeError('supplied cube map is using unsupported, non-square dimensions')
-    if not texcubemap.might_have_ram_image():
-        raise RuntimeError('expected might_have_ram_image() to be true on supplied texture')
 
-    peeker = texcubemap.peek()
+COMPONENT_DTYPES: Final = {
+    p3d.Texture.T_byte: np.int8,
+    p3d.Texture.T_short: np.int16,
+    p3d.Texture.T_unsigned_byte: np.uint8,
+    p3d.Texture.T_unsigned_short: np.uint16,
+    p3d.Texture.T_half_float: np.float16,
+    p3d.Texture.T_float: np.float32,
+}
+
+
+def decode_srgb(vals: FloatArrayType) -> FloatArrayType:
+    return np.where(vals <= 0.04045, vals / 12.92, ((vals + 0.055) / 1.055) ** 2.4)
+
+
+SRGB_FORMATS: Final = (
+    p3d.Texture.F_srgb,
+    p3d.Texture.F_srgb_alpha,
+    p3d.Texture.F_sluminance,
+    p3d.Texture.F_sluminance_alpha,
+)
 
-    if peeker is None:
-        raise RuntimeError('unable to get TexturePeeker for texture')
 
+def get_cube_map_faces(texcubemap: p3d.Texture) -> FloatArrayType:
+    # Linear RGB colors of every texel of every face, indexed by (face, y, x)
     dim = texcubemap.x_size
-    invdim = 1.0 / dim
-
-    shcoeffs = [
-        p3d.LVector3(0, 0, 0),
-        p3d.LVector3(0, 0, 0),
-        p3d.LVector3(0, 0, 0),
-        p3d.LVector3(0, 0, 0),
-        p3d.LVector3(0, 0, 0),
-        p3d.LVector3(0, 0, 0),
-        p3d.LVector3(0, 0, 0),
-        p3d.LVector3(0, 0, 0),
-        p3d.LVector3(0, 0, 0),
-    ]
-    colorptr = p3d.LColor()
-
-    # SH Basis
-    for face in range(texcubemap.z_size):
-        for x in range(texcubemap.x_size):
-            for y in range(texcubemap.y_size):
-                # Grab the color value
-                peeker.fetch_pixel(colorptr, x, y, face)
-                color = colorptr.xyz
-
-                # Use SA as a weight to better handle corners (box vs sphere)
-                color *= calc_solid_angle(invdim, x, y)
-
-                # Multiply color by SH basis and add results
-                vec = calc_vector(dim, face, x, y)
-                basis = get_sh_basis_from_vector(vec)
-                for idx, value in enumerate(basis):
-                    shcoeffs[idx] += color * value
+    dtype = COMPONENT_DTYPES.get(texcubemap.component_type)
 
-    # Convolution with cosine lobe for irradiance
-    # this is actually for reconstruction, but we can bake it in here to avoid
-    # extra math in the shader
-    a0 = 3.141593 # pi
-    a1 = 2.094395 # 2/3 pi
-    a2 = 0.785398 # 1/4 pi
-    shcoeffs[0] *= a0
-    shcoeffs[1] *= a1
-    shcoeffs[2] *= a1
-    shcoeffs[3] *= a1
-    shcoeffs[4] *= a2
-    shcoeffs[5] *= a2
-    shcoeffs[6] *= a2
-    shcoeffs[7] *= a2
+    if dtype is None:
+        # Let the peeker deal with any other component types it supports
+        peeker = texcubemap.peek()
+        if peeker is None:
+            raise RuntimeError('unable to get TexturePeeker for texture')
 
-    return shcoeffs
+        faces = np.empty((6, dim, dim, 3), dtype=np.float32)
+        color = p3d.LColor()
+        for face in range(6):
+            for y in range(dim):
+                for x in range(dim):
+                    peeker.fetch_pixel(color, x, y, face)
+                    faces[face, y, x] = color.xyz
+        return faces
 
+    ram_image = texcubemap.get_ram_image_as('RGB')
+    if not ram_image:
+        raise RuntimeError('unable to get RAM image for texture')
 
-def van_der_corput(idx: int, base: int = 2) -> float:
-    result = 0.0
-    denom = 1
+    faces = np.frombuffer(ram_image, dtype=dtype).reshape(6, dim, dim, 3).astype(np.float32)
+    if np.issubdtype(dtype, np.integer):
+        # Signed types are normalized like GL does, clamping the most negative value to -1
+        faces = np.maximum(faces / np.iinfo(dtype).max, -1)
 
-    while idx:
-        denom *= base
-        idx, rem = divmod(idx, base)
-        result += rem / denom
+    if texcubemap.format in SRGB_FORMATS:
+        faces = decode_srgb(faces)
 
-    return result
+    return faces
 
 
-@functools.lru_cache(maxsize=None)
-def hammersley(idx: int, maxnum: int) -> Vec2TupleType:
-    return (idx / maxnum, van_der_corput(idx))
+# Largest cube map dimension used for computing spherical harmonics
+SH_MAX_DIM: Final = 64
 
 
-VEC_Z: Final = p3d.LVector3(0, 0, 1)
-VEC_X: Final = p3d.LVector3(1, 0, 0)
-def importance_sample_ggx(
-    xi: Vec2TupleType,
-    normal: p3d.LVector3,
-    roughness: float
-) -> p3d.LVector3:
-    alpha = roughness * roughness
+def area_resample_weights(srcdim: int, dstdim: int) -> FloatArrayType:
+    # Fraction of every destination texel covered by every source texel, indexed by
+    # (dst, src), so each row sums to one
+    srcedges = np.arange(srcdim + 1) / srcdim
+    dstedges = np.arange(dstdim + 1) / dstdim
+    overlap = (
+        np.minimum(dstedges[1:, None], srcedges[None, 1:])
+        - np.maximum(dstedges[:-1, None], srcedges[None, :-1])
+    )
+    return (np.maximum(overlap, 0) * dstdim).astype(np.float32)
 
-    phi = 2 * math.pi * xi[0]
-    costheta = math.sqrt((1 - xi[1]) / (1 + (alpha * alpha - 1) * xi[1]))
-    sintheta = math.sqrt(1 - costheta * costheta)
 
-    hvec_x = math.cos(phi) * sintheta
-    hvec_y = math.sin(phi) * sintheta
-    hvec_z = costheta
+# Cube maps are always downsampled to at most SH_MAX_DIM first, so a few entries cover
+# the sizes in use while bounding the memory held by the cache
+@functools.lru_cache(maxsize=4)
+def sh_projection_matrix(dim: int) -> FloatArrayType:
+    # Maps the (texel, rgb) colors of a cube map to its SH coefficients with a single
+    # matrix product; it only depends on the dimensions, so it is shared between cube maps
 
-    upvec = VEC_Z if abs(normal.z < 0.999) else VEC_X
-    tangent = upvec.cross(normal)
-    tangent.normalize()
-    bitangent = normal.cross(tangent)
+    # The basis functions expect unit vectors, so project texel directions onto the sphere
+    basis = get_sh_basis_from_vector(normalize(calc_vectors(dim)))
 
-    return (tangent * hvec_x + bitangent * hvec_y + normal * hvec_z).normalized()
+    # Use SA as a weight to better handle corners (box vs sphere)
+    basis = basis * calc_solid_angles(dim)[..., None]
 
-def geometry_schlick_ggx(ndotv: float, roughness: float) -> float:
-    alpha = roughness
-    kibl = alpha * alpha / 2
+    # Convolution with cosine lobe for irradiance
+    # this is actually for reconstruction, but we can bake it in here to avoid
+    # extra math in the shader
+    a0 = 3.141593 # pi
+    a1 = 2.094395 # 2/3 pi
+    a2 = 0.785398 # 1/4 pi
+    basis *= np.array([a0, a1, a1, a1, a2, a2, a2, a2, a2])
 
-    return ndotv / (ndotv * (1 - kibl) + kibl)
+    matrix = np.ascontiguousarray(basis.reshape(-1, 9).T)
+    matrix.flags.writeable = False
+    return matrix
 
 
-def geometry_smith(
-    normal: p3d.LVector3,
-    view: p3d.LVector3,
-    light: p3d.LVector3,
-    roughness: float
-) -> float:
-    ndotv = max(normal.dot(view), 0)
-    ndotl = max(normal.dot(light), 0)
+def get_sh_coeffs_from_cube_map(texcubemap: p3d.Texture) -> list[p3d.LVector3]:
+    if texcubemap.z_size != 6:
+        raise RuntimeError('supplied texture was not a cube map')
+    if texcubemap.x_size != texcubemap.y_size:
+        raise RuntimeError('supplied cube map is using unsupported, non-square dimensions')
+    if not texcubemap.might_have_ram_image():
+        raise RuntimeError('expected might_have_ram_image() to be true on supplied texture')
 
-    return geometry_schlick_ggx(ndotv, roughness) * geometry_schlick_ggx(ndotl, roughness)
+    faces = get_cube_map_faces(texcubemap)
+    dim = texcubemap.x_size
 
+    # Nine coefficients only capture very low frequencies, so box filter large cube maps
+    # down first: the coefficients barely change while the work shrinks quadratically
+    while dim > SH_MAX_DIM and dim % 2 == 0:
+        dim //= 2
+        faces = faces.reshape(6, dim, 2, dim, 2, 3).mean(axis=(2, 4))
 
-def integrate_brdf(ndotv: float, roughness: float, num_samples: int = 1024) -> p3d.LVector2:
-    ndotv = max(ndotv, 0.0001)
-    view = p3d.LVector3(
-        math.sqrt(1 - ndotv * ndotv),
-        0,
-        ndotv
-    )
-    normal = p3d.LVector3(0, 0, 1)
-    retval = p3d.LVector2(0, 0)
+    # Halving cannot continue past an odd dimension, so finish with an area resample
+    if dim > SH_MAX_DIM:
+        weights = area_resample_weights(dim, SH_MAX_DIM)
+        faces = np.einsum('yj,fjkc,xk->fyxc', weights, faces, weights, optimize=True)
+        dim = SH_MAX_DIM
+
+    shcoeffs = sh_projection_matrix(dim) @ faces.reshape(-1, 3)
+
+    return [p3d.LVector3(*coeff) for coeff in shcoeffs]
 
-    for idx in range(num_samples):
-        xi = hammersley(idx, num_samples)
-        hvec = importance_sample_ggx(xi, normal, roughness)
-        light = hvec * 2 * view.dot(hvec) - view
-        light.normalize()
 
-        ndotl = max(light.z, 0)
+def reverse_bits(vals: npt.NDArray[np.uint32]) -> npt.NDArray[np.uint32]:
+    # Swap progressively larger groups of bits (SWAR) to reverse all 32 bits at once
+    vals = ((vals >> 1) & 0x55555555) | ((vals & 0x55555555) << 1)
+    vals = ((vals >> 2) & 0x33333333) | ((vals & 0x33333333) << 2)
+    vals = ((vals >> 4) & 0x0F0F0F0F) | ((vals & 0x0F0F0F0F) << 4)
+    vals = ((vals >> 8) & 0x00FF00FF) | ((vals & 0x00FF00FF) << 8)
+    return (vals >> 16) | ((vals & 0xFFFF) << 16)
+
+
+@functools.lru_cache(maxsize=None)
+def hammersley_table(num_samples: int) -> FloatArrayType:
+    # The base 2 radical inverse of an index is its bits mirrored around the binary point
+    idxs = np.arange(num_samples, dtype=np.uint32)
+    radical_inverse = reverse_bits(idxs) / 2.0 ** 32
+
+    table = np.stack([idxs / num_samples, radical_inverse], axis=-1).astype(np.float32)
 
-        if ndotl > 0:
-            ndoth = max(hvec.z, 0)
-            vdoth = max(view.dot(hvec), 0)
-            geom = geometry_smith(normal, view, light, roughness)
-            geom_vis = (geom * vdoth) / (ndoth * ndotv)
-            fresnel = math.pow(1 - vdoth, 5)
+    # lru_cache hands every caller this same array, so guard it against writes
+    table.flags.writeable = False
+    return table
 
-            retval.x += (1 - fresnel) * geom_vis
-            retval.y += fresnel * geom_vis
 
+def normalize(vecs: FloatArrayType) -> FloatArrayType:
+    return vecs / np.linalg.norm(vecs, axis=-1, keepdims=True)
 
-    retval /= num_samples
-    return retval
 
+def importance_sample_ggx(xi: FloatArrayType, roughness: float) -> FloatArrayType:
+    # Tangent space half vectors (normal = (0, 0, 1)) for every point in xi
+    alpha = roughness * roughness
 
-def gen_brdf_lut(lutsize: int, num_samples: int = 1024) -> p3d.Texture:
+    phi = 2 * np.pi * xi[:, 0]
+    costheta = np.sqrt((1 - xi[:, 1]) / (1 + (alpha * alpha - 1) * xi[:, 1]))
+    sintheta = np.sqrt(1 - costheta * costheta)
+
+    return np.stack([
+        np.cos(phi) * sintheta,
+        np.sin(phi) * sintheta,
+        costheta,
+    ], axis=-1)
+
+
+VEC_Z: Final = np.array([0.0, 0.0, 1.0], dtype=np.float32)
+VEC_X: Final = np.array([1.0, 0.0, 0.0], dtype=np.float32)
+def tangent_frame(normal: FloatArrayType) -> FloatArrayType:
+    # Rows of the result are the tangent, bitangent, and normal, so tangent space vectors
+    # can be transformed with vec @ frame
+    upvec = np.where(np.abs(normal[..., 2:]) < 0.999, VEC_Z, VEC_X)
+    tangent = normalize(np.cross(upvec, normal))
+    bitangent = np.cross(normal, tangent)
+
+    return np.stack([tangent, bitangent, normal], axis=-2)
+
+
+def integrate_brdf(
+    ndotv: FloatArrayType,
+    roughness: FloatArrayType,
+    num_samples: int = 64
+) -> FloatArrayType:
+    # Evaluate every (roughness, ndotv, sample) combination at once: roughness varies
+    # along the first axis, ndotv along the second, and samples along the last
+    xi = hammersley_table(num_samples)
+    roughness = np.asarray(roughness)[:, None, None]
+    ndotv = np.maximum(np.asarray(ndotv), 0.0001)[None, :, None]
+    view_x = np.sqrt(1 - ndotv * ndotv)
+    view_z = ndotv
+
+    # Sample the GGX distribution of visible normals around normal = (0, 0, 1) using
+    # spherical caps (Dupuy and Benyoub, "Sampling Visible GGX Normals with Spherical
+    # Caps"); the view vector lies in the xz-plane
+    alpha = roughness * roughness
+    view_len = np.sqrt(alpha * alpha * view_x * view_x + view_z * view_z)
+    vhemi_x = alpha * view_x / view_len
+    vhemi_z = view_z / view_len
+
+    phi = 2 * np.pi * xi[:, 0]
+    cap_z = (1 - xi[:, 1]) * (1 + vhemi_z) - vhemi_z
+    sintheta = np.sqrt(np.clip(1 - cap_z * cap_z, 0, 1))
+    hvec_x = alpha * (sintheta * np.cos(phi) + vhemi_x)
+    hvec_y = alpha * (sintheta * np.sin(phi))
+    hvec_z = cap_z + vhemi_z
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hvec_len = np.sqrt(hvec_x * hvec_x + hvec_y * hvec_y + hvec_z * hvec_z)
+        vdoth = (hvec_x * view_x + hvec_z * view_z) / hvec_len
+        ndotl = np.maximum(2 * vdoth * hvec_z / hvec_len - view_z, 0)
+        vdoth = np.maximum(vdoth, 0)
+
+        # The VNDF pdf cancels D, the view masking term, and the ndoth / vdoth factors,
+        # leaving only the Smith GGX masking term for the light direction
+        alpha2 = alpha * alpha
+        geom_vis = np.where(
+            ndotl > 0,
+            2 * ndotl / (ndotl + np.sqrt(alpha2 + (1 - alpha2) * ndotl * ndotl)),
+            0
+        )
+    fresnel = (1 - vdoth) ** 5
+
+    return np.stack([
+        ((1 - fresnel) * geom_vis).sum(axis=-1),
+        (fresnel * geom_vis).sum(axis=-1),
+    ], axis=-1) / num_samples
+
+
+# Upper bound on the number of (pixel, sample) pairs integrated at once
+MAX_BATCH_SIZE: Final = 1 << 18
+
+
+def gen_brdf_lut(lutsize: int, num_samples: int = 64) -> p3d.Texture:
     brdflut = p3d.Texture('brdf_lut')
-    brdflut.setup_2d_texture(lutsize, lutsize, p3d.Texture.T_float, p3d.Texture.F_rg16)
+    brdflut.setup_2d_texture(
+        lutsize,
+        lutsize,
+        p3d.Texture.T_half_float,
+        p3d.Texture.F_rg16
+    )
     brdflut.wrap_u = p3d.SamplerState.WM_clamp
     brdflut.wrap_v = p3d.SamplerState.WM_clamp
     brdflut.minfilter = p3d.SamplerState.FT_linear
     brdflut.magfilter = p3d.SamplerState.FT_linear
 
-    handle = typing.cast(memoryview, brdflut.modify_ram_image())
-    pixelsize = brdflut.component_width * brdflut.num_components
-    xsize = brdflut.x_size
+    # ndotv varies along x and roughness along y
+    coords = np.arange(lutsize, dtype=np.float32) / lutsize
+
+    # Half floats match the precision of the F_rg16 format
+    lut = np.frombuffer(brdflut.modify_ram_image(), dtype=np.float16)
+    lut = lut.reshape(lutsize, lutsize, 2)
+
+    # Rows are independent, so split them into batches that are integrated in parallel
+    # (NumPy releases the GIL while crunching the arrays)
+    num_workers = os.cpu_count() or 1
+    rows_per_batch = max(min(
+        MAX_BATCH_SIZE // (lutsize * num_samples),
+        -(-lutsize // num_workers),
+    ), 1)
 
-    for ycoord in range(lutsize):
-        for xcoord in range(lutsize):
-            idx = (ycoord * xsize + xcoord) * pixelsize
-            result = integrate_brdf(xcoord / lutsize, ycoord / lutsize, num_samples)
-            struct.pack_into('ff', handle, idx, result[0], result[1])
+    def integrate_rows(start: int) -> None:
+        stop = start + rows_per_batch
+        lut[start:stop] = integrate_brdf(coords, coords[start:stop], num_samples)
+
+    with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+        # Consume the results so exceptions from workers are propagated
+        list(executor.map(integrate_rows, range(0, lutsize, rows_per_batch)))
 
     return brdflut
 
 
+def sample_cube_map(faces: FloatArrayType, dirs: FloatArrayType) -> FloatArrayType:
+    # Bilinear lookup of directions (components along the last axis) in a cube map
+    # indexed by (face, y, x), using the inverse of the mapping in calc_vectors()
+    dim = faces.shape[1]
+    maxidx = dim - 1
+
+    # Faces are ordered +x, -x, +y, -y, +z, -z
+    axis = np.argmax(np.abs(dirs), axis=-1)[..., None]
+    face = axis[..., 0] * 2 + (np.take_along_axis(dirs, axis, axis=-1)[..., 0] < 0)
+
+    # Project onto the face axes to get back (xcoord, ycoord, major) scaled by major; each
+    # axis is a signed unit axis, so this only needs to gather and flip components
+    local = np.take_along_axis(dirs, CUBE_FACE_COMPONENTS[face], axis=-1)
+    local *= CUBE_FACE_SIGNS[face]
+    xcoord = local[..., 0] / local[..., 2]
+    ycoord = local[..., 1] / local[..., 2]
+
+    xloc = np.clip((xcoord + 1) * (dim / 2) - 0.5, 0, maxidx)
+    yloc = np.clip((1 - ycoord) * (dim / 2) - 0.5, 0, maxidx)
+    x0 = xloc.astype(int)
+    y0 = yloc.astype(int)
+    x1 = np.minimum(x0 + 1, maxidx)
+    y1 = np.minimum(y0 + 1, maxidx)
+    xfrac = (xloc - x0)[..., None]
+    yfrac = (yloc - y0)[..., None]
+
+    top = faces[face, y0, x0] * (1 - xfrac) + faces[face, y0, x1] * xfrac
+    bottom = faces[face, y1, x0] * (1 - xfrac) + faces[face, y1, x1] * xfrac
+    return top * (1 - yfrac) + bottom * yfrac
+
+
 def filter_sample(
-    pos: p3d.LVector3,
-    envmap: p3d.TexturePeeker,
-    roughness: float,
-    num_samples: int
-) -> p3d.LVector3:
-    view = normal = pos.normalized()
-    totweight = 0.0
-    retval = p3d.LVector3(0.0, 0.0, 0.0)
-    colorptr = p3d.LColor()
-
-    for idx in range(num_samples):
-        xi = hammersley(idx, num_samples)
-        hvec = importance_sample_ggx(xi, normal, roughness)
-        light = hvec * 2.0 * view.dot(hvec) - view
-        light.normalize()
-
-        ndotl = max(normal.dot(light), 0.0)
-        if ndotl > 0.0:
-            envmap.lookup(colorptr, light.x, light.y, light.z)
-            retval += colorptr.xyz * ndotl
-            totweight += ndotl
-
-    retval /= totweight
-    return retval
+    pos: FloatArrayType,
+    envmap: FloatArrayType,
+    hvecs: FloatArrayType
+) -> FloatArrayType:
+    # Pre-filtered color for every direction in pos given tangent space half vectors from
+    # importance_sample_ggx(), with samples along a new axis
+    normal = normalize(pos)
+
+    # The frame is orthonormal and both vectors are unit length, so neither the half
+    # vectors nor the reflected light vectors need to be normalized again
+    hvec = hvecs @ tangent_frame(normal)
+    view = normal = normal[..., None, :]
+    light = hvec * 2.0 * np.sum(view * hvec, axis=-1, keepdims=True) - view
+
+    ndotl = np.maximum(np.sum(normal * light, axis=-1), 0.0)
+    colors = sample_cube_map(envmap, light)
+
+    # The first Hammersley point always yields light == normal, so totweight is never zero
+    totweight = np.sum(ndotl, axis=-1)[..., None]
+    return np.einsum('...n,...nc->...c', ndotl, colors) / totweight
 
 
 def filter_env_map(
@@ -299,7 +410,7 @@ def filter_env_map(
         num_mipmaps: int = 4,
         num_samples: int = 4
     ) -> None:
-    peeker = envmap.peek()
+    envfaces = get_cube_map_faces(envmap)
 
     filtered.setup_cube_map(size, p3d.Texture.T_float, p3d.Texture.F_rgb32)
     filtered.magfilter = p3d.SamplerState.FT_linear
@@ -307,20 +418,44 @@ def filter_env_map(
 
     pixelsize = filtered.component_width * filtered.num_components
 
-    for i in range(num_mipmaps):
-        mipsize = int(size * 0.5 ** i)
-        roughness = 1 if num_mipmaps == 1 else i / (num_mipmaps - 1)
-        texdata = p3d.PTA_uchar.empty_array(mipsize * mipsize * 6 * pixelsize)
-
-        for face in range(6):
-            for xcoord in range(mipsize):
-                for ycoord in range(mipsize):
-                    offset = ((face * mipsize + ycoord) * mipsize + xcoord) * pixelsize
-                    vec = calc_vector(mipsize, face, xcoord, ycoord)
-                    pos = p3d.LVector3(vec[0], vec[1], vec[2])
-                    result = filter_sample(pos, peeker, roughness, num_samples)
-                    struct.pack_into(
-                        'fff',
-                        typing.cast(memoryview, texdata), offset, result[2], result[1], result[0]
-                    )
+    def filter_rows(
+        mipimage: FloatArrayType,
+        positions: FloatArrayType,
+        hvecs: FloatArrayType
+    ) -> None:
+        # RAM images store colors as BGR
+        mipimage[...] = filter_sample(positions, envfaces, hvecs)[..., ::-1]
+
+    # Every (mipmap, face, row batch) writes to its own slice of a RAM image, so they
+    # can be filtered in parallel without any locking
+    ramimages = []
+    with concurrent.futures.ThreadPoolExecutor(os.cpu_count()) as executor:
+        jobs = []
+        for i in range(num_mipmaps):
+            mipsize = int(size * 0.5 ** i)
+            roughness = 1 if num_mipmaps == 1 else i / (num_mipmaps - 1)
+            positions = calc_vectors(mipsize)
+            hvecs = importance_sample_ggx(hammersley_table(num_samples), roughness)
+
+            # Write results directly into the RAM image
+            texdata = p3d.PTA_uchar.empty_array(6 * mipsize * mipsize * pixelsize)
+            ramimages.append(texdata)
+            mipimage = np.frombuffer(texdata, dtype=np.float32).reshape(6, mipsize, mipsize, 3)
+
+            rows_per_batch = max(MAX_BATCH_SIZE // (mipsize * num_samples), 1)
+            for face in range(6):
+                for start in range(0, mipsize, rows_per_batch):
+                    stop = start + rows_per_batch
+                    jobs.append(executor.submit(
+                        filter_rows,
+                        mipimage[face, start:stop],
+                        positions[face, start:stop],
+                        hvecs
+                    ))
+
+        # Propagate any exceptions from the workers
+        for job in jobs:
+            job.result()
+
+    for i, texdata in enumerate(ramimages):
         filtered.set_ram_mipmap_image(i, texdata)
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import hashlib
 from pathlib import Path
 import time
 import typing
@@ -42,6 +43,7 @@ class EnvMap:
 
         self._prefiltered_size = prefiltered_size
         self._prefiltered_samples = prefiltered_samples
+        self._hash: str | None = None
         self.is_prepared = p3d.AsyncFuture()
 
         self._blocking_prepare = blocking_prepare
@@ -55,8 +57,24 @@ class EnvMap:
 
     @property
     def hash(self) -> str:
-        name = hash(self.cubemap.fullpath)
-        return f'{name}{self._prefiltered_size}{self._prefiltered_samples}'
+        # Key on the cube map contents rather than its path so edits to the source
+        # image and changes to the IBL functions both invalidate cached results
+        # Hashing the whole RAM image is not free, so only do it once
+        if self._hash is None:
+            hasher = hashlib.blake2b(digest_size=16)
+            ram_image = self.cubemap.get_ram_image()
+            if ram_image:
+                hasher.update(ram_image)
+            elif self.cubemap.has_fullpath():
+                hasher.update(self.cubemap.fullpath.get_fullpath().encode())
+            else:
+                raise RuntimeError('unable to hash a cube map without a RAM image or file path')
+            hasher.update(
+                f'{self._prefiltered_size}-{self._prefiltered_samples}-{iblfuncs.VERSION}'.encode()
+            )
+            self._hash = hasher.hexdigest()
+
+        return self._hash
 
     def prepare(self) -> p3d.AsyncFuture:
         def calc_sh() -> None:
@@ -129,6 +147,7 @@ class EnvMap:
         bfile.write_object(self.cubemap)
         bfile.write_object(self.filtered_env_map)
         bfile.writer.target.put_datagram(shcoeffs_data)
+        bfile.close()
 
     @classmethod
     def _from_bam(cls, path: p3d.Filename) -> Self:
@@ -1,6 +1,8 @@
 from __future__ import annotations
 
+import os
 from pathlib import Path
+import tempfile
 
 import panda3d.core as p3d
 
@@ -26,7 +28,25 @@ class EnvPool:
 
     def _write_cache(self, future: p3d.AsyncFuture) -> None:
         envmap = future.result()
-        envmap.write(self._get_cache_path(envmap))
+        cache_path = self._get_cache_path(envmap)
+
+        # Write to a uniquely named temporary file first so a partially written cache file
+        # is never read, even if several loads of the same image finish at once
+        cache_path_os = cache_path.to_os_specific()
+        cache_dir = os.path.dirname(cache_path_os)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmpfd, tmp_path = tempfile.mkstemp(
+            suffix='.tmp',
+            prefix=f'{os.path.basename(cache_path_os)}.',
+            dir=cache_dir,
+        )
+        os.close(tmpfd)
+        try:
+            envmap.write(p3d.Filename.from_os_specific(tmp_path))
+            os.replace(tmp_path, cache_path_os)
+        except Exception:
+            os.remove(tmp_path)
+            raise
 
     def load(
         self,
@@ -2,6 +2,7 @@ import os
 import time
 
 import panda3d.core as p3d
+import pytest
 
 import simplepbr
 
@@ -27,3 +28,30 @@ def test_envmap_bam_write(tmpdir):
     outpath = tmpdir / 'cubemap.env'
     envmap.write(outpath)
     assert os.path.exists(outpath)
+
+
+def make_cube_map(value):
+    cubemap = p3d.Texture()
+    cubemap.setup_cube_map(2, p3d.Texture.T_unsigned_byte, p3d.Texture.F_rgb)
+    cubemap.set_ram_image(bytes([value]) * (2 * 2 * 6 * 3))
+    return cubemap
+
+
+def test_envmap_hash():
+    cubemap = make_cube_map(0)
+    envmap = simplepbr.EnvMap(cubemap, skip_prepare=True)
+
+    envhash = envmap.hash
+    assert envmap.hash == envhash
+    assert simplepbr.EnvMap(cubemap.make_copy(), skip_prepare=True).hash == envhash
+    assert simplepbr.EnvMap(cubemap, prefiltered_size=8, skip_prepare=True).hash != envhash
+    assert simplepbr.EnvMap(make_cube_map(255), skip_prepare=True).hash != envhash
+
+
+def test_envmap_hash_no_source():
+    cubemap = p3d.Texture()
+    cubemap.setup_cube_map(2, p3d.Texture.T_unsigned_byte, p3d.Texture.F_rgb)
+    envmap = simplepbr.EnvMap(cubemap, skip_prepare=True)
+
+    with pytest.raises(RuntimeError):
+        envmap.hash # pylint: disable=pointless-statement
@@ -15,3 +15,22 @@ def test_envpool_load_str():
     env = pool.load(ASSETDIR / 'hdri' / 'cubemap_#.hdr')
 
     assert env.cubemap
+
+
+def test_envpool_write_cache(tmpdir, monkeypatch):
+    pool = simplepbr.EnvPool()
+    cubemap = p3d.Texture()
+    cubemap.setup_cube_map(2, p3d.Texture.T_unsigned_byte, p3d.Texture.F_rgb)
+    cubemap.set_ram_image(bytes(2 * 2 * 6 * 3))
+    envmap = simplepbr.EnvMap(cubemap, skip_prepare=True)
+    envmap.is_prepared.set_result(envmap)
+    cache_path = p3d.Filename.from_os_specific(str(tmpdir / f'{envmap.hash}.env'))
+    monkeypatch.setattr(pool, '_get_cache_path', lambda _: cache_path)
+
+    # Writing the same cache file twice must not trip over a shared temporary file
+    pool._write_cache(envmap.is_prepared) # pylint: disable=protected-access
+    pool._write_cache(envmap.is_prepared) # pylint: disable=protected-access
+
+    assert os.listdir(tmpdir) == [f'{envmap.hash}.env']
+    cached = simplepbr.EnvMap.from_file_path(cache_path)
+    assert cached.cubemap.x_size == envmap.cubemap.x_size
@@ -0,0 +1,155 @@
+import math
+
+import numpy as np
+import panda3d.core as p3d
+import pytest
+
+from simplepbr import _ibl_funcs_cpu as iblfuncs
+
+
+def make_cube_map(dim, bgr, texformat=p3d.Texture.F_rgb):
+    texcubemap = p3d.Texture()
+    texcubemap.setup_cube_map(dim, p3d.Texture.T_unsigned_byte, texformat)
+    texcubemap.set_ram_image(bytes(bgr) * (dim * dim * 6))
+    return texcubemap
+
+
+def test_reverse_bits():
+    vals = np.array([0, 1, 6, 1 << 31, 0xFFFFFFFF], dtype=np.uint32)
+    np.testing.assert_array_equal(
+        iblfuncs.reverse_bits(vals),
+        [0, 1 << 31, 0x60000000, 1, 0xFFFFFFFF]
+    )
+
+
+def test_hammersley_table():
+    xi = iblfuncs.hammersley_table(8)
+    assert xi.shape == (8, 2)
+    np.testing.assert_allclose(xi[:, 0], np.arange(8) / 8)
+    np.testing.assert_allclose(xi[:, 1], [0, 0.5, 0.25, 0.75, 0.125, 0.625, 0.375, 0.875])
+
+
+def test_integrate_brdf():
+    coords = np.arange(8) / 8
+    lut = iblfuncs.integrate_brdf(coords, coords, num_samples=64)
+
+    assert lut.shape == (8, 8, 2)
+    assert np.all(np.isfinite(lut))
+    assert np.all(lut >= 0)
+    assert np.all(lut.sum(axis=-1) <= 1.0001)
+
+    # A perfectly smooth surface reflects everything
+    np.testing.assert_allclose(lut[0].sum(axis=-1), 1, rtol=1e-5)
+
+
+def test_gen_brdf_lut():
+    brdflut = iblfuncs.gen_brdf_lut(8, num_samples=16)
+    assert brdflut.x_size == 8
+    assert brdflut.y_size == 8
+    assert brdflut.component_type == p3d.Texture.T_half_float
+    assert brdflut.has_ram_image()
+
+    # Every row batch lands in the right place of the half float RAM image
+    lut = np.frombuffer(brdflut.get_ram_image(), dtype=np.float16).reshape(8, 8, 2)
+    coords = np.arange(8, dtype=np.float32) / 8
+    expected = iblfuncs.integrate_brdf(coords, coords, num_samples=16)
+    np.testing.assert_allclose(lut, expected, atol=1e-3)
+
+
+@pytest.mark.parametrize('dim', [8, 128, 127])
+def test_sh_coeffs_constant_color(dim):
+    texcubemap = make_cube_map(dim, (255, 255, 255))
+
+    shcoeffs = iblfuncs.get_sh_coeffs_from_cube_map(texcubemap)
+    assert len(shcoeffs) == 9
+
+    # Only the constant band contributes for a uniformly lit environment
+    expected = 0.282095 * 4 * math.pi * math.pi
+    for component in shcoeffs[0]:
+        assert math.isclose(component, expected, rel_tol=1e-4)
+    for coeff in shcoeffs[1:]:
+        assert coeff.length() < 1e-4
+
+
+def test_cube_map_faces_srgb():
+    texcubemap = make_cube_map(4, (0, 128, 255), p3d.Texture.F_srgb)
+    faces = iblfuncs.get_cube_map_faces(texcubemap)
+
+    assert faces.shape == (6, 4, 4, 3)
+    np.testing.assert_allclose(faces.reshape(-1, 3), np.broadcast_to(
+        [1.0, 0.2158605, 0.0], (6 * 4 * 4, 3)
+    ), rtol=1e-5)
+
+
+def test_cube_map_faces_signed():
+    texcubemap = p3d.Texture()
+    texcubemap.setup_cube_map(2, p3d.Texture.T_byte, p3d.Texture.F_rgb)
+    texcubemap.set_ram_image(np.array([-128, 0, 127], dtype=np.int8).tobytes() * (2 * 2 * 6))
+    faces = iblfuncs.get_cube_map_faces(texcubemap)
+
+    # RAM images are BGR
+    np.testing.assert_allclose(faces.reshape(-1, 3), np.broadcast_to([1, 0, -1], (24, 3)))
+
+
+def test_cube_map_faces_peeker_fallback():
+    texcubemap = p3d.Texture()
+    texcubemap.setup_cube_map(2, p3d.Texture.T_unsigned_int, p3d.Texture.F_rgb)
+    texcubemap.set_ram_image(np.array([0, 0, 0xFFFFFFFF], dtype=np.uint32).tobytes() * 24)
+    faces = iblfuncs.get_cube_map_faces(texcubemap)
+
+    np.testing.assert_allclose(faces.reshape(-1, 3), np.broadcast_to([1, 0, 0], (24, 3)))
+
+
+def test_filter_env_map_constant_color():
+    envmap = make_cube_map(8, (51, 102, 204))
+    filtered = p3d.Texture()
+    iblfuncs.filter_env_map(envmap, filtered, size=8, num_mipmaps=2, num_samples=4)
+
+    # Filtering a constant environment leaves it unchanged (RAM images are BGR)
+    for mipmap in range(2):
+        data = np.frombuffer(filtered.get_ram_mipmap_image(mipmap), dtype=np.float32)
+        expected = np.broadcast_to([0.2, 0.4, 0.8], (data.size // 3, 3))
+        np.testing.assert_allclose(data.reshape(-1, 3), expected, rtol=1e-5)
+
+
+def test_tangent_frame_orthonormal():
+    normals = iblfuncs.normalize(np.array([
+        [1, 0, 0],
+        [-1, 0, 0],
+        [0, 1, 0],
+        [0, 0, 1],
+        [0, 0, -1],
+        [1, 2, 3],
+    ], dtype=np.float64))
+    frames = iblfuncs.tangent_frame(normals)
+
+    identity = np.broadcast_to(np.eye(3), frames.shape)
+    np.testing.assert_allclose(frames @ np.swapaxes(frames, -1, -2), identity, atol=1e-7)
+    np.testing.assert_allclose(frames[:, 2], normals)
+
+
+def test_sample_cube_map_texel_directions():
+    faces = np.random.default_rng(0).random((6, 8, 8, 3))
+    colors = iblfuncs.sample_cube_map(faces, iblfuncs.calc_vectors(8))
+    np.testing.assert_allclose(colors, faces, atol=1e-5)
+
+
+def test_area_resample_weights():
+    weights = iblfuncs.area_resample_weights(5, 2)
+    np.testing.assert_allclose(weights, [
+        [0.4, 0.4, 0.2, 0, 0],
+        [0, 0, 0.2, 0.4, 0.4],
+    ], atol=1e-7)
+
+    # Power of two ratios reduce to a box filter
+    np.testing.assert_allclose(iblfuncs.area_resample_weights(4, 2), [
+        [0.5, 0.5, 0, 0],
+        [0, 0, 0.5, 0.5],
+    ])
+
+
+def test_calc_solid_angles():
+    solid_angles = iblfuncs.calc_solid_angles(8)
+    assert solid_angles.shape == (8, 8)
+    assert np.all(solid_angles > 0)
+    assert math.isclose(solid_angles.sum() * 6, 4 * math.pi)